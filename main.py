@@ -1,13 +1,24 @@
 import os
+import asyncio
 import sqlite3
+import queue
+import concurrent.futures
+import threading
 import time
-import uuid
+import glob
+import hashlib
 import aiohttp
 import re
 import shutil
+from pathlib import Path
 from typing import List, Optional
-import base64
 import mimetypes
+from collections import OrderedDict
+
+try:
+    import pybase64 as _b64  # SIMD 加速的 Base64 编码，可选依赖
+except ImportError:
+    import base64 as _b64
 
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
@@ -22,22 +33,55 @@ from astrbot.api.message_components import Plain, Image, BaseMessageComponent
     "0.2.6.0" # 版本升级：修复消息重复注入问题，并精确实现对当前消息的增强逻辑
 )
 class PersistentChatPlugin(Star):
+    _IMAGE_RE = re.compile(r"\[图片:([^\]]+)\]")
+    _SHA256_RE = re.compile(r"[0-9a-f]{64}")
+    # 常见图片类型直接查表，仅未知扩展名才交给 mimetypes
+    _MIME_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.webp': 'image/webp', '.gif': 'image/gif'}
+    _MIME_EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp', 'image/gif': '.gif'}
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.config = config
         self.db_conn = None
         self.db_cursor = None
+        self.db_path = None
         self.plugin_data_dir = os.path.join("data", "persistent_chat")
         self.images_dir = os.path.join(self.plugin_data_dir, "images")
+        # 图片 URI 的 LRU 缓存，避免每轮重复读取与编码
+        # 键为 (投递方式, sha256)（数据库中的图片）或 (路径, mtime_ns, 大小)（旧版磁盘图片）
+        self._b64_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        self._b64_cache_bytes = 0
+        self._b64_cache_max_entries = 64
+        self._b64_cache_max_bytes = 32 * 1024 * 1024
+        # 单写线程独占写连接，事件循环只负责投递；读操作经 to_thread 在主连接上执行
+        self._write_q: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer_thread: Optional[threading.Thread] = None
+        self._writer_batch_size = 64
+        self._writer_checkpoint_every = 1000  # 每写入这么多条操作后截断一次 WAL 文件
+        self._db_lock = threading.Lock()
+        # 复用同一个 HTTP 会话以保持连接池，避免每张图片都重新握手
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._http_lock = asyncio.Lock()
         self._setup_database_and_dirs()
 
     def _setup_database_and_dirs(self):
         try:
             os.makedirs(self.plugin_data_dir, exist_ok=True)
             os.makedirs(self.images_dir, exist_ok=True)
-            db_path = os.path.join(self.plugin_data_dir, "chat_history.db")
-            self.db_conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.db_path = os.path.join(self.plugin_data_dir, "chat_history.db")
+            is_new_db = not os.path.exists(self.db_path) or os.path.getsize(self.db_path) == 0
+            self.db_conn = sqlite3.connect(self.db_path, check_same_thread=False)
             self.db_cursor = self.db_conn.cursor()
+            if is_new_db:
+                # 页大小只能在建表前（且切换到 WAL 前）设置，因此仅对新数据库生效
+                self.db_cursor.execute("PRAGMA page_size=8192")
+            # WAL 模式下 synchronous=NORMAL 是安全的，且读写互不阻塞
+            self.db_cursor.execute("PRAGMA journal_mode=WAL")
+            self.db_cursor.execute("PRAGMA synchronous=NORMAL")
+            self.db_cursor.execute("PRAGMA temp_store=MEMORY")
+            self.db_cursor.execute("PRAGMA cache_size=-20000")  # 约 20 MiB
+            self.db_cursor.execute("PRAGMA busy_timeout=5000")
+            self.db_cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
             self.db_cursor.execute('''
                 CREATE TABLE IF NOT EXISTS chat_logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -48,64 +92,441 @@ class PersistentChatPlugin(Star):
                     timestamp INTEGER NOT NULL
                 )
             ''')
+            # 按会话倒序取最近 N 条时可直接沿索引反向扫描，无需排序
+            self.db_cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chatlogs_session_id ON chat_logs(session_id, id DESC)"
+            )
+            # 图片按内容 sha256 去重存储，消息中以 [图片:<sha256>] 引用
+            self.db_cursor.execute('''
+                CREATE TABLE IF NOT EXISTS images (
+                    id INTEGER PRIMARY KEY,
+                    sha256 TEXT NOT NULL UNIQUE,
+                    mime TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    source_url TEXT
+                )
+            ''')
             self.db_conn.commit()
+            self._writer_thread = threading.Thread(target=self._writer_loop, name="PersistentChatWriter", daemon=True)
+            self._writer_thread.start()
             logger.info("PersistentChat: 数据库和目录初始化成功。")
         except Exception as e:
             logger.error(f"PersistentChat: 数据库或目录初始化失败: {e}")
 
-    async def _download_image(self, url: str) -> Optional[str]:
+    async def _get_http_session(self) -> aiohttp.ClientSession:
+        if self._http is None or self._http.closed:
+            async with self._http_lock:
+                if self._http is None or self._http.closed:
+                    self._http = aiohttp.ClientSession(
+                        connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300),
+                        timeout=aiohttp.ClientTimeout(total=15)
+                    )
+        return self._http
+
+    async def _download_image(self, url: str) -> Optional[tuple]:
+        """下载图片，返回待写入 images 表的 (sha256, mime, data, 来源链接)。"""
         if not url or not url.startswith(('http://', 'https://')): return None
         try:
-            file_ext = os.path.splitext(url.split('?')[0])[-1] or '.png'
-            if len(file_ext) > 5 or len(file_ext) < 2: file_ext = '.png'
-            filename = f"{int(time.time())}_{uuid.uuid4().hex[:8]}{file_ext}"
-            filepath = os.path.join(self.images_dir, filename)
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as resp:
-                    if resp.status == 200:
-                        with open(filepath, 'wb') as f: f.write(await resp.read())
-                        return filename
-            return None
+            max_bytes = int(self.config.get('max_image_size_mb', 20) * 1024 * 1024)
+            session = await self._get_http_session()
+            async with session.get(url) as resp:
+                if resp.status != 200: return None
+                if resp.content_length and resp.content_length > max_bytes:
+                    logger.warning(f"PersistentChat: 图片过大 ({resp.content_length} 字节)，已跳过: {url}")
+                    return None
+                data, digest = bytearray(), hashlib.sha256()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    data += chunk
+                    digest.update(chunk)
+                    if len(data) > max_bytes:
+                        logger.warning(f"PersistentChat: 图片超过 {max_bytes} 字节上限，已丢弃: {url}")
+                        return None
+                mime_type = resp.content_type if resp.content_type.startswith('image/') else None
+            if not mime_type:
+                mime_type = self._guess_mime_type(url.split('?')[0])
+            # 此处不写库：图片与引用它的记录由 _save_log_to_db 一并入队
+            return digest.hexdigest(), mime_type, data, url  # sqlite3 可直接绑定 bytearray，避免再复制一份
         except Exception as e:
             logger.error(f"PersistentChat: 下载图片时发生错误: {e}")
             return None
 
-    def _path_to_base64(self, file_path: str) -> Optional[str]:
+    @classmethod
+    def _guess_mime_type(cls, path: str) -> str:
+        ext = os.path.splitext(path)[1].lower()
+        return cls._MIME_TYPES.get(ext) or mimetypes.guess_type(path)[0] or "image/png"
+
+    @classmethod
+    def _guess_extension(cls, mime_type: str) -> str:
+        return cls._MIME_EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type) or '.png'
+
+    def _b64_cache_get(self, key) -> Optional[str]:
+        uri = self._b64_cache.get(key)
+        if uri is not None:
+            self._b64_cache.move_to_end(key)
+        return uri
+
+    def _b64_cache_put(self, key, uri: str):
+        # 并发注入可能对同一个键重复写入，需先扣除旧值的大小
+        old = self._b64_cache.pop(key, None)
+        if old is not None: self._b64_cache_bytes -= len(old)
+        if len(uri) > self._b64_cache_max_bytes: return
+        self._b64_cache[key] = uri
+        self._b64_cache_bytes += len(uri)
+        while len(self._b64_cache) > self._b64_cache_max_entries or self._b64_cache_bytes > self._b64_cache_max_bytes:
+            _, evicted = self._b64_cache.popitem(last=False)
+            self._b64_cache_bytes -= len(evicted)
+
+    def _b64_cache_clear(self):
+        self._b64_cache.clear()
+        self._b64_cache_bytes = 0
+
+    @staticmethod
+    def _is_legacy_image_name(ref: str) -> bool:
+        """旧版图片标记中的文件名必须是 images 目录下的单纯文件名，防止 [图片:../xxx] 之类的路径穿越。"""
+        return bool(ref) and ref not in ('.', '..') and '/' not in ref and '\\' not in ref and os.path.basename(ref) == ref
+
+    def _path_to_base64(self, filename: str) -> Optional[str]:
+        """读取旧版保存在磁盘上的图片并转换为 Base64 URI。"""
+        if not self._is_legacy_image_name(filename): return None
+        file_path = os.path.join(self.images_dir, filename)
         try:
-            if not os.path.exists(file_path):
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
                 logger.warning(f"PersistentChat: 文件不存在，无法转换为Base64: {file_path}")
                 return None
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if not mime_type: mime_type = "image/png"
+            cache_key = (file_path, st.st_mtime_ns, st.st_size)
+            cached = self._b64_cache_get(cache_key)
+            if cached is not None: return cached
+            mime_type = self._guess_mime_type(file_path)
             with open(file_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            return f"data:{mime_type};base64,{encoded_string}"
+                encoded_string = _b64.b64encode(image_file.read()).decode('ascii')
+            uri = f"data:{mime_type};base64,{encoded_string}"
+            self._b64_cache_put(cache_key, uri)
+            return uri
         except Exception as e:
             logger.error(f"PersistentChat: 转换文件到Base64失败: {file_path}, 错误: {e}")
             return None
 
-    async def _process_message_chain(self, chain: List[BaseMessageComponent]) -> str:
-        parts = []
+    def _load_history(self, session_id: str, bot_self_id: str, limit: int, delivery: Optional[str]):
+        """在工作线程中执行：读取会话最近的记录（新→旧），返回 (角色, 发送者, 图片列表, 文本)，
+        同时复制已缓存图片的 URI 并为未缓存的图片生成 URI。delivery 为 None 时不加载图片。"""
+        with self._db_lock:
+            rows = [
+                (role, sender_name, *self._split_image_markers(message_text))
+                for role, sender_name, message_text in self.db_conn.execute(
+                    "SELECT CASE WHEN sender_id = ? THEN 'assistant' ELSE 'user' END, sender_name, message_text "
+                    "FROM chat_logs WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                    (bot_self_id, session_id, limit)
+                )
+            ]
+            # 直接复制命中的 URI，而不是只判断是否存在：回到事件循环前缓存项可能已被其他会话挤出
+            cached, missing = {}, []
+            if delivery:
+                for ref in dict.fromkeys(ref for row in rows for ref in row[2]):
+                    if not self._SHA256_RE.fullmatch(ref): continue
+                    uri = self._b64_cache.get((delivery, ref))
+                    if uri is not None: cached[ref] = uri
+                    else: missing.append(ref)
+            fresh, pending = {}, missing
+            if missing and delivery in ('url', 'path'):
+                # url/path 方式下多数图片无需 BLOB，先只查元数据，仅对需要回退的图片读取 data 列
+                pending = []
+                for sha256, mime_type, source_url in self.db_conn.execute(
+                    f"SELECT sha256, mime, source_url FROM images WHERE sha256 IN ({','.join('?' * len(missing))})", missing
+                ):
+                    uri = self._image_uri(delivery, sha256, mime_type, None, source_url)
+                    if uri: fresh[sha256] = uri
+                    else: pending.append(sha256)
+            blobs = self.db_conn.execute(
+                f"SELECT sha256, mime, data, source_url FROM images WHERE sha256 IN ({','.join('?' * len(pending))})",
+                pending
+            ).fetchall() if pending else []
+        for sha256, mime_type, data, source_url in blobs:
+            uri = self._image_uri(delivery, sha256, mime_type, data, source_url)
+            if uri: fresh[sha256] = uri
+        return rows, cached, fresh
+
+    def _image_uri(self, delivery: str, sha256: str, mime_type: str, data: Optional[bytes], source_url: Optional[str]) -> Optional[str]:
+        """按投递方式生成数据库中图片的 URI：url 使用原始链接，path 导出为本地文件，其余情况回退为 Base64。
+        data 为 None 时只尝试无需图片数据的方式，需要数据才能生成时返回 None。"""
+        if delivery == 'url' and source_url:
+            return source_url
+        if delivery == 'path':
+            file_path = os.path.abspath(os.path.join(self.images_dir, sha256 + self._guess_extension(mime_type)))
+            if os.path.exists(file_path): return Path(file_path).as_uri()
+            if data is None: return None
+            try:
+                tmp_path = f"{file_path}.tmp"
+                with open(tmp_path, 'wb') as f: f.write(data)
+                os.replace(tmp_path, file_path)
+                return Path(file_path).as_uri()
+            except Exception as e:
+                logger.warning(f"PersistentChat: 导出图片到本地失败，改用Base64: {file_path}, 错误: {e}")
+        if data is None: return None
+        return f"data:{mime_type};base64,{_b64.b64encode(data).decode('ascii')}"
+
+    def _resolve_image_uris(self, image_refs: List[str], cached: dict, fresh: dict, delivery: str) -> dict:
+        """将图片引用解析为 URI。数据库中的图片使用工作线程取得的缓存副本或本轮新生成的 URI，旧版文件名从磁盘读取。"""
+        uris = {}
+        for ref in dict.fromkeys(image_refs):
+            if self._SHA256_RE.fullmatch(ref):
+                uri = self._b64_cache_get((delivery, ref)) or cached.get(ref)
+            elif not self._is_legacy_image_name(ref):
+                uri = None
+            elif delivery == 'path':
+                file_path = os.path.abspath(os.path.join(self.images_dir, ref))
+                uri = Path(file_path).as_uri() if os.path.exists(file_path) else None
+            else:
+                uri = self._path_to_base64(ref)
+            if uri: uris[ref] = uri
+        # 先取缓存命中项，再写入新生成的 URI，避免本轮写入把本轮要用的缓存项挤出
+        for sha256, uri in fresh.items():
+            self._b64_cache_put((delivery, sha256), uri)
+            uris[sha256] = uri
+        return uris
+
+    async def _process_message_chain(self, chain: List[BaseMessageComponent]):
+        """返回 (消息文本, 待写入的图片行列表)。"""
+        parts, downloads = [], []
         for comp in chain:
             if isinstance(comp, Plain) and comp.text.strip():
                 parts.append(comp.text.strip())
             elif isinstance(comp, Image):
                 url_to_download = getattr(comp, 'url', None) or getattr(comp, 'file', None)
                 if url_to_download:
-                    saved_filename = await self._download_image(url_to_download)
-                    parts.append(f"[图片:{saved_filename}]" if saved_filename else "[图片下载失败]")
-        return " ".join(parts).strip()
+                    downloads.append((len(parts), url_to_download))
+                    parts.append(None)
+        # 同一条消息中的多张图片并发下载，并发数由共享连接池限制
+        results = await asyncio.gather(*(self._download_image(url) for _, url in downloads), return_exceptions=True)
+        image_rows = {}
+        for (index, _), image_row in zip(downloads, results):
+            if image_row and not isinstance(image_row, BaseException):
+                image_rows.setdefault(image_row[0], image_row)
+                parts[index] = f"[图片:{image_row[0]}]"
+            else:
+                parts[index] = "[图片下载失败]"
+        return " ".join(parts).strip(), list(image_rows.values())
 
-    def _save_log_to_db(self, session_id, sender_id, sender_name, message_text):
-        if not message_text: return
+    def _writer_loop(self):
+        """写线程：从队列中批量取出写操作，合并为一个事务提交。收到 None 时退出。
+        队列中的元素为 (sql, 参数)，或 (函数, Future) 形式的任务，任务在写连接上按入队顺序执行。"""
         try:
-            self.db_cursor.execute(
-                "INSERT INTO chat_logs (session_id, sender_id, sender_name, message_text, timestamp) VALUES (?, ?, ?, ?, ?)",
-                (session_id, sender_id, sender_name, message_text, int(time.time()))
-            )
-            self.db_conn.commit()
+            conn = sqlite3.connect(self.db_path, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+        except Exception as e:
+            logger.error(f"PersistentChat: 写线程连接数据库失败，聊天记录将不会被保存: {e}")
+            self._discard_queued_writes()
+            return
+        running, writes_since_checkpoint = True, 0
+        while running:
+            batch = [self._write_q.get()]
+            while len(batch) < self._writer_batch_size:
+                try: batch.append(self._write_q.get_nowait())
+                except queue.Empty: break
+            ops = [op for op in batch if op is not None]
+            running = len(ops) == len(batch)
+            try:
+                if ops:
+                    self._apply_ops(conn, ops)
+                    writes_since_checkpoint += len(ops)
+                    if writes_since_checkpoint >= self._writer_checkpoint_every:
+                        writes_since_checkpoint = 0
+                        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except Exception as e:
+                logger.error(f"PersistentChat: 写线程处理写操作时出错: {e}")
+            finally:
+                for _ in batch: self._write_q.task_done()
+        conn.close()
+        self._discard_queued_writes()
+
+    def _apply_ops(self, conn: sqlite3.Connection, ops: List[tuple]):
+        """按顺序执行一批操作：遇到任务时先提交其之前的写入，再在写连接上执行任务。"""
+        start = 0
+        for i, (target, arg) in enumerate(ops):
+            if not callable(target): continue
+            if start < i: self._apply_writes(conn, ops[start:i])
+            self._run_task(conn, target, arg)
+            start = i + 1
+        if start < len(ops): self._apply_writes(conn, ops[start:])
+
+    @staticmethod
+    def _run_task(conn: sqlite3.Connection, fn, future: concurrent.futures.Future):
+        if not future.set_running_or_notify_cancel(): return
+        try:
+            future.set_result(fn(conn))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _apply_writes(self, conn: sqlite3.Connection, ops: List[tuple]):
+        """将一批写操作放在同一事务中提交；失败时回滚并逐条重试，只丢弃出错的那一条。"""
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # 相邻的同类语句合并为一次 executemany
+            i = 0
+            while i < len(ops):
+                sql = ops[i][0]
+                j = i
+                while j < len(ops) and ops[j][0] == sql: j += 1
+                conn.executemany(sql, [params for _, params in ops[i:j]])
+                i = j
+            conn.execute("COMMIT")
+            return
         except Exception as e:
-            logger.error(f"PersistentChat: 记录到数据库时出错: {e}")
+            self._rollback(conn)
+            logger.warning(f"PersistentChat: 批量写入数据库时出错，改为逐条写入: {e}")
+        for sql, params in ops:
+            try:
+                conn.execute(sql, params)
+            except Exception as e:
+                self._rollback(conn)
+                logger.error(f"PersistentChat: 写入数据库时出错，丢弃该条操作: {e}")
+
+    @staticmethod
+    def _rollback(conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+        except Exception as e:
+            logger.error(f"PersistentChat: 回滚事务失败: {e}")
+
+    def _discard_queued_writes(self):
+        """写线程退出时清空队列，避免等待队列清空或等待任务结果的协程被永久阻塞。"""
+        while True:
+            try: op = self._write_q.get_nowait()
+            except queue.Empty: return
+            if op is not None and callable(op[0]) and op[1].set_running_or_notify_cancel():
+                op[1].set_exception(RuntimeError("写线程已退出"))
+            self._write_q.task_done()
+
+    def _writer_alive(self) -> bool:
+        return self._writer_thread is not None and self._writer_thread.is_alive()
+
+    def _enqueue_write(self, sql: str, params: tuple) -> bool:
+        if not self._writer_alive():
+            logger.error("PersistentChat: 写线程未运行，无法写入数据库。")
+            return False
+        self._write_q.put_nowait((sql, params))
+        return True
+
+    def _enqueue_task(self, fn) -> Optional[concurrent.futures.Future]:
+        """将 fn(写连接) 排入写队列，在其之前入队的写入提交后执行。写线程未运行时返回 None。"""
+        if not self._writer_alive():
+            logger.error("PersistentChat: 写线程未运行，无法执行数据库任务。")
+            return None
+        future = concurrent.futures.Future()
+        self._write_q.put_nowait((fn, future))
+        return future
+
+    @classmethod
+    def _split_image_markers(cls, text: str):
+        """一次遍历同时提取图片文件名并去除图片标记，返回 (文件名列表, 剩余文本)。"""
+        image_filenames, parts, pos = [], [], 0
+        for m in cls._IMAGE_RE.finditer(text):
+            image_filenames.append(m.group(1))
+            parts.append(text[pos:m.start()])
+            pos = m.end()
+        if not image_filenames: return image_filenames, text.strip()
+        parts.append(text[pos:])
+        return image_filenames, "".join(parts).strip()
+
+    @staticmethod
+    def _collapse_text_content(msg: dict):
+        msg['content'] = " ".join(item.get('text', '') for item in msg['content']).strip()
+
+    async def _flush_writes(self):
+        """等待写队列清空，读取前调用以保证读到最新写入。写线程未运行时直接返回。"""
+        if not self._writer_alive(): return
+        await asyncio.to_thread(self._write_q.join)
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._db_lock:
+            return self.db_conn.execute(sql, params).fetchall()
+
+    def _execute(self, sql: str, params: tuple = ()) -> int:
+        with self._db_lock:
+            cursor = self.db_conn.execute(sql, params)
+            self.db_conn.commit()
+            return cursor.rowcount
+
+    def _delete_session_logs(self, session_id: str):
+        """在工作线程中执行：删除会话的记录，返回 (记录数, 记录中引用的图片集合)。"""
+        with self._db_lock:
+            try:
+                image_refs = {
+                    ref for (message_text,) in self.db_conn.execute("SELECT message_text FROM chat_logs WHERE session_id = ?", (session_id,))
+                    for ref in self._IMAGE_RE.findall(message_text)
+                }
+                deleted_count = self.db_conn.execute("DELETE FROM chat_logs WHERE session_id = ?", (session_id,)).rowcount
+                self.db_conn.commit()
+            except Exception:
+                self.db_conn.rollback()
+                raise
+        return deleted_count, image_refs
+
+    def _delete_orphan_images(self, conn: sqlite3.Connection, image_hashes: List[str]):
+        """在写线程中执行：删除已无记录引用的图片，返回 (删除数, 被删除的哈希集合)。
+        与写队列串行执行，图片总是与引用它的记录相邻入队，因此不会删掉即将被新记录引用的图片。"""
+        orphan_hashes = set(image_hashes) - self._find_referenced_images(conn, image_hashes)
+        if not orphan_hashes: return 0, set()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            deleted = conn.execute(
+                f"DELETE FROM images WHERE sha256 IN ({','.join('?' * len(orphan_hashes))})", list(orphan_hashes)
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            self._rollback(conn)
+            raise
+        return deleted, orphan_hashes
+
+    def _find_referenced_images(self, conn: sqlite3.Connection, image_hashes: List[str]) -> set:
+        """一次扫描剩余的聊天记录，返回其中仍被引用的图片哈希。"""
+        if not image_hashes: return set()
+        candidates, referenced = set(image_hashes), set()
+        for (message_text,) in conn.execute("SELECT message_text FROM chat_logs WHERE instr(message_text, '[图片:') > 0"):
+            referenced.update(candidates.intersection(self._IMAGE_RE.findall(message_text)))
+            if len(referenced) == len(candidates): break
+        return referenced
+
+    def _delete_image_files(self, image_refs: set, removed_hashes: set) -> int:
+        """删除旧版按文件名保存的图片（计入返回的删除数量），并清理 path 投递方式为已删除图片导出的副本。"""
+        deleted = self._bulk_delete_files([
+            os.path.join(self.images_dir, ref) for ref in image_refs
+            if not self._SHA256_RE.fullmatch(ref) and self._is_legacy_image_name(ref)
+        ])
+        self._bulk_delete_files(
+            [path for sha256 in removed_hashes for path in glob.glob(os.path.join(self.images_dir, f"{sha256}.*"))]
+        )
+        return deleted
+
+    @staticmethod
+    def _bulk_delete_files(paths: List[str]) -> int:
+        deleted = 0
+        for path in paths:
+            try:
+                os.unlink(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"PersistentChat: 删除图片 {path} 时失败: {e}")
+        return deleted
+
+    def _save_log_to_db(self, session_id, sender_id, sender_name, message_text, timestamp: int, image_rows: List[tuple] = ()):
+        if not message_text: return
+        # 图片与引用它的记录连续入队（中间没有 await），写线程上的孤儿图片清理只会排在两者之前或之后。
+        # 已存在的图片（如表情包）冲突时不会重写 BLOB，仅为旧数据补上来源链接
+        for image_row in image_rows:
+            if not self._enqueue_write(
+                "INSERT INTO images (sha256, mime, data, source_url) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(sha256) DO UPDATE SET source_url = excluded.source_url WHERE images.source_url IS NULL",
+                image_row
+            ): return
+        self._enqueue_write(
+            "INSERT INTO chat_logs (session_id, sender_id, sender_name, message_text, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (session_id, sender_id, sender_name, message_text, timestamp)
+        )
     
     @filter.event_message_type(filter.EventMessageType.ALL, priority=10)
     async def log_user_message(self, event: AstrMessageEvent):
@@ -113,9 +534,10 @@ class PersistentChatPlugin(Star):
         if (event.is_private_chat() and not self.config.get('log_private_messages', False)) or \
            (not event.is_private_chat() and not self.config.get('log_group_messages', True)) or \
            (event.get_sender_id() == event.get_self_id()): return
+        timestamp = int(time.time())  # 以收到消息的时间为准，而非图片下载完成的时间
         message_chain = event.get_messages()
-        processed_text = await self._process_message_chain(message_chain)
-        self._save_log_to_db(event.unified_msg_origin, event.get_sender_id(), event.get_sender_name(), processed_text)
+        processed_text, image_rows = await self._process_message_chain(message_chain)
+        self._save_log_to_db(event.unified_msg_origin, event.get_sender_id(), event.get_sender_name(), processed_text, timestamp, image_rows)
 
     @filter.after_message_sent()
     async def log_bot_response(self, event: AstrMessageEvent):
@@ -123,8 +545,9 @@ class PersistentChatPlugin(Star):
         if not self.config.get('log_self_messages', True): return
         result = event.get_result()
         if not result or not result.chain: return
-        processed_text = await self._process_message_chain(result.chain)
-        self._save_log_to_db(event.unified_msg_origin, event.get_self_id(), "assistant", processed_text)
+        timestamp = int(time.time())
+        processed_text, image_rows = await self._process_message_chain(result.chain)
+        self._save_log_to_db(event.unified_msg_origin, event.get_self_id(), "assistant", processed_text, timestamp, image_rows)
 
     @filter.on_llm_request(priority=1)
     async def inject_chat_history(self, event: AstrMessageEvent, req: ProviderRequest):
@@ -133,64 +556,57 @@ class PersistentChatPlugin(Star):
         if max_history <= 0: return
 
         try:
-            image_pattern = re.compile(r"\[图片:([^\]]+)\]")
-            bot_self_id = event.get_self_id()
             current_turn_contexts = req.contexts or []
             req.contexts.clear()
+            await self._flush_writes()
 
-            # --- 1. 获取所有相关记录，包括当前消息 ---
-            self.db_cursor.execute(
-                "SELECT sender_id, sender_name, message_text FROM chat_logs WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?",
-                (event.unified_msg_origin, max_history + 1)
+            # --- 1. 获取所有相关记录（包括当前消息）及其引用的图片，只需一次线程切换 ---
+            # 纯文本模型无需图片，直接走文本路径，跳过图片的读取与编码
+            multimodal = self.config.get('multimodal', True)
+            delivery = self.config.get('image_delivery', 'base64') if multimodal else None
+            rows, cached_uris, fresh_uris = await asyncio.to_thread(
+                self._load_history, event.unified_msg_origin, event.get_self_id(), max_history + 1, delivery
             )
-            rows = self.db_cursor.fetchall()
             if not rows: # 如果数据库为空，直接使用框架的上下文
                 req.contexts = current_turn_contexts
                 return
 
             # --- 2. 分离当前消息和历史记录 ---
-            current_msg_row = rows.pop(0) # 最新的消息是当前消息
-            history_rows = rows
-            history_rows.reverse() # 恢复时间顺序
+            _role, _sender_name, image_filenames, text_part = rows[0] # 最新的消息是当前消息
+            history_rows = rows[:0:-1] # 其余记录恢复时间顺序
+            image_uris = self._resolve_image_uris([ref for row in rows for ref in row[2]], cached_uris, fresh_uris, delivery) if multimodal else {}
 
             # --- 3. 处理历史记录 ---
             history_contexts = []
             text_only_contexts = []
-            for sender_id, sender_name, message_text in history_rows:
-                role = "assistant" if sender_id == bot_self_id else "user"
-                image_filenames = image_pattern.findall(message_text)
-                text_part = image_pattern.sub("", message_text).strip()
-                if image_filenames and not text_part: text_part = "[用户发送了图片]"
+            for role, sender_name, row_image_filenames, row_text_part in history_rows:
+                if row_image_filenames and not row_text_part: row_text_part = "[用户发送了图片]"
+                if not row_text_part: continue
+
+                display_name = sender_name or "User"
+                text_only_content = f"{'[图片]' * len(row_image_filenames)} {row_text_part}".strip()
+                if role == "user": text_only_content = f"{display_name}: {text_only_content}"
+                text_only_contexts.append({'role': role, 'content': text_only_content})
+                if not multimodal:
+                    history_contexts.append({'role': role, 'content': text_only_content})
+                    continue
 
                 content_list = []
-                for filename in image_filenames:
-                    image_path = os.path.join(self.images_dir, filename)
-                    base64_uri = self._path_to_base64(image_path)
+                for filename in row_image_filenames:
+                    base64_uri = image_uris.get(filename)
                     if base64_uri: content_list.append({"type": "image_url", "image_url": {"url": base64_uri}})
-                if text_part: content_list.append({"type": "text", "text": text_part})
-                if not content_list: continue
-
-                text_only_content = f"{'[图片]' * len(image_filenames)} {text_part}".strip()
+                content_list.append({"type": "text", "text": row_text_part})
                 if role == "user":
-                    display_name = sender_name or "User"
-                    text_only_content = f"{display_name}: {text_only_content}"
-                    if content_list and content_list[0]['type'] == 'text': content_list[0]['text'] = f"{display_name}: {content_list[0]['text']}"
+                    if content_list[0]['type'] == 'text': content_list[0]['text'] = f"{display_name}: {content_list[0]['text']}"
                     else: content_list.insert(0, {'type': 'text', 'text': f"{display_name}: "})
                 
                 history_contexts.append({'role': role, 'content': content_list})
-                text_only_contexts.append({'role': role, 'content': text_only_content})
 
             # --- 4. 根据规则增强当前消息 ---
-            _sender_id, _sender_name, current_message_text = current_msg_row
-            image_filenames = image_pattern.findall(current_message_text)
-            text_part = image_pattern.sub("", current_message_text).strip()
-            
             # 找到框架提供的当前用户消息
-            target_index = -1
-            for i in range(len(current_turn_contexts) - 1, -1, -1):
-                if current_turn_contexts[i].get('role') == 'user':
-                    target_index = i
-                    break
+            target_index = next(
+                (i for i in reversed(range(len(current_turn_contexts))) if current_turn_contexts[i].get('role') == 'user'), -1
+            )
 
             if target_index != -1:
                 if image_filenames and not text_part: # 规则3: 只有图片
@@ -199,11 +615,10 @@ class PersistentChatPlugin(Star):
                         {"type": "text", "text": "[用户最新消息只发送了图片]"}
                     ]
                 
-                if image_filenames: # 规则2 & 3: 只要有图片，就注入
+                if image_filenames and multimodal: # 规则2 & 3: 只要有图片，就注入
                     image_parts = []
                     for filename in image_filenames:
-                        image_path = os.path.join(self.images_dir, filename)
-                        base64_uri = self._path_to_base64(image_path)
+                        base64_uri = image_uris.get(filename)
                         if base64_uri: image_parts.append({"type": "image_url", "image_url": {"url": base64_uri}})
                     
                     # 确保 content 是 list
@@ -220,20 +635,22 @@ class PersistentChatPlugin(Star):
                 event.set_extra('text_only_history', text_only_contexts)
                 return
 
-            merged_contexts = [final_contexts[0]]
-            for i in range(1, len(final_contexts)):
-                current_msg, last_msg = final_contexts[i], merged_contexts[-1]
-                if current_msg['role'] == last_msg['role']:
-                    last_content = last_msg['content'] if isinstance(last_msg['content'], list) else [{'type': 'text', 'text': str(last_msg['content'])}]
-                    current_content = current_msg['content'] if isinstance(current_msg['content'], list) else [{'type': 'text', 'text': str(current_msg['content'])}]
-                    last_msg['content'] = last_content + current_content
-                else:
-                    merged_contexts.append(current_msg)
-
-            for msg in merged_contexts:
-                content = msg.get('content')
-                if isinstance(content, list) and all(item.get('type') == 'text' for item in content):
-                    msg['content'] = " ".join(item.get('text', '') for item in content).strip()
+            # 合并相邻同角色消息；一条消息完成合并时，若全为文本则折叠为字符串
+            merged_contexts = []
+            all_text = False
+            for msg in final_contexts:
+                content = msg['content']
+                items = content if isinstance(content, list) else [{'type': 'text', 'text': str(content)}]
+                items_all_text = all(item.get('type') == 'text' for item in items)
+                if merged_contexts and merged_contexts[-1]['role'] == msg['role']:
+                    merged_contexts[-1]['content'].extend(items)
+                    all_text = all_text and items_all_text
+                    continue
+                if all_text: self._collapse_text_content(merged_contexts[-1])
+                msg['content'] = list(items)
+                merged_contexts.append(msg)
+                all_text = items_all_text
+            if all_text: self._collapse_text_content(merged_contexts[-1])
 
             req.contexts = merged_contexts
             event.set_extra('text_only_history', text_only_contexts)
@@ -257,11 +674,12 @@ class PersistentChatPlugin(Star):
             yield event.plain_result("查看的条数必须在 1 到 50 之间。")
             return
         try:
-            self.db_cursor.execute(
+            await self._flush_writes()
+            rows = await asyncio.to_thread(
+                self._query,
                 "SELECT sender_name, message_text FROM chat_logs WHERE session_id = ? ORDER BY id DESC LIMIT ?",
                 (event.unified_msg_origin, count)
             )
-            rows = self.db_cursor.fetchall()
             rows.reverse()
             if not rows:
                 yield event.plain_result("当前会话没有聊天记录。")
@@ -280,26 +698,17 @@ class PersistentChatPlugin(Star):
         """清空当前会话的所有聊天记录及关联图片。"""
         event.set_extra("is_command_response", True)
         try:
-            self.db_cursor.execute("SELECT message_text FROM chat_logs WHERE session_id = ?", (event.unified_msg_origin,))
-            rows = self.db_cursor.fetchall()
-            image_pattern = re.compile(r"\[图片:([^\]]+)\]")
-            images_to_delete = set()
-            for row in rows:
-                found_images = image_pattern.findall(row[0])
-                for img in found_images:
-                    images_to_delete.add(img)
-            self.db_cursor.execute("DELETE FROM chat_logs WHERE session_id = ?", (event.unified_msg_origin,))
-            self.db_conn.commit()
-            deleted_count = self.db_cursor.rowcount
-            deleted_images_count = 0
-            for filename in images_to_delete:
-                try:
-                    filepath = os.path.join(self.images_dir, filename)
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
-                        deleted_images_count += 1
-                except Exception as img_e:
-                    logger.warning(f"PersistentChat: 删除图片 {filename} 时失败: {img_e}")
+            await self._flush_writes()
+            deleted_count, image_refs = await asyncio.to_thread(self._delete_session_logs, event.unified_msg_origin)
+            # 数据库中的图片可能被其他会话引用，仅删除已无引用的；清理在写线程上执行，与新记录的写入串行
+            image_hashes = [ref for ref in image_refs if self._SHA256_RE.fullmatch(ref)]
+            deleted_images_count, removed_hashes = 0, set()
+            if image_hashes:
+                future = self._enqueue_task(lambda conn: self._delete_orphan_images(conn, image_hashes))
+                if future is not None:
+                    deleted_images_count, removed_hashes = await asyncio.wrap_future(future)
+            deleted_images_count += await asyncio.to_thread(self._delete_image_files, image_refs, removed_hashes)
+            self._b64_cache_clear()
             yield event.plain_result(f"成功清空了当前会话的 {deleted_count} 条聊天记录，并删除了 {deleted_images_count} 张关联图片。")
         except Exception as e:
             logger.error(f"PersistentChat: 清空当前会话历史时出错: {e}")
@@ -311,10 +720,10 @@ class PersistentChatPlugin(Star):
         """(仅管理员) 清空所有聊天记录和已保存的图片。"""
         event.set_extra("is_command_response", True)
         try:
-            self.db_cursor.execute("SELECT COUNT(*) FROM chat_logs")
-            deleted_count = self.db_cursor.fetchone()[0]
-            self.db_cursor.execute("DELETE FROM chat_logs")
-            self.db_conn.commit()
+            await self._flush_writes()
+            deleted_count = await asyncio.to_thread(self._execute, "DELETE FROM chat_logs")
+            await asyncio.to_thread(self._execute, "DELETE FROM images")
+            self._b64_cache_clear()
             if os.path.exists(self.images_dir):
                 shutil.rmtree(self.images_dir)
             os.makedirs(self.images_dir, exist_ok=True)
@@ -324,8 +733,18 @@ class PersistentChatPlugin(Star):
             yield event.plain_result(f"清空全部失败: {e}")
             
     async def terminate(self):
-        """插件终止时，安全地关闭数据库连接。"""
+        """插件终止时，安全地关闭 HTTP 会话与数据库连接。"""
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        if self._writer_thread is not None and self._writer_thread.is_alive():
+            self._write_q.put(None)
+            await asyncio.to_thread(self._writer_thread.join)
         if self.db_conn:
+            try:
+                self.db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.db_conn.execute("PRAGMA optimize")
+            except Exception as e:
+                logger.warning(f"PersistentChat: 关闭前整理数据库失败: {e}")
             self.db_conn.close()
             logger.info("PersistentChat: 数据库连接已关闭。")
 
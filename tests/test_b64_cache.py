@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("astrbot")
+
+from main import PersistentChatPlugin  # noqa: E402
+
+
+def _make_cache_only_plugin(max_entries=64, max_bytes=32 * 1024 * 1024):
+    plugin = object.__new__(PersistentChatPlugin)
+    plugin._b64_cache = OrderedDict()
+    plugin._b64_cache_bytes = 0
+    plugin._b64_cache_max_entries = max_entries
+    plugin._b64_cache_max_bytes = max_bytes
+    return plugin
+
+
+def test_put_same_key_twice_keeps_byte_count():
+    plugin = _make_cache_only_plugin()
+    uri = "data:image/png;base64," + "A" * 3000
+    plugin._b64_cache_put(("base64", "x"), uri)
+    plugin._b64_cache_put(("base64", "x"), uri)
+    assert len(plugin._b64_cache) == 1
+    assert plugin._b64_cache_bytes == len(uri)
+
+
+def test_replacing_value_accounts_for_new_length():
+    plugin = _make_cache_only_plugin()
+    plugin._b64_cache_put("k", "a" * 10)
+    plugin._b64_cache_put("k", "b" * 4)
+    assert plugin._b64_cache_get("k") == "b" * 4
+    assert plugin._b64_cache_bytes == 4
+
+
+def test_eviction_keeps_byte_count_consistent():
+    plugin = _make_cache_only_plugin(max_entries=2)
+    for key in ("a", "b", "a", "c"):
+        plugin._b64_cache_put(key, key * 5)
+    assert list(plugin._b64_cache) == ["a", "c"]
+    assert plugin._b64_cache_bytes == sum(len(v) for v in plugin._b64_cache.values())